@@ -152,6 +152,14 @@ RECOVERING_LONG_POLL_BROADCAST_TIMEOUT_S = 10.0
 # Minimum duration to wait until broadcasting model IDs.
 PUSH_MULTIPLEXED_MODEL_IDS_INTERVAL_S = 1.0
 
+# Enable the (costly) internal consistency checks of the deployment scheduler.
+RAY_SERVE_SCHEDULER_DEBUG = os.environ.get("RAY_SERVE_SCHEDULER_DEBUG", "0") == "1"
+
+# Maximum age of the cluster node list cached by the deployment scheduler.
+DEPLOYMENT_SCHEDULER_NODE_CACHE_TTL_S = float(
+    os.environ.get("RAY_SERVE_DEPLOYMENT_SCHEDULER_NODE_CACHE_TTL_S", "1")
+)
+
 
 class ServeHandleType(str, Enum):
     SYNC = "SYNC"
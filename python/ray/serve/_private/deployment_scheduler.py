@@ -1,12 +1,29 @@
-from typing import Callable, Dict, Tuple, List, Union, Set
+import heapq
+import logging
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from itertools import chain
+from typing import Callable, Dict, Tuple, List, Optional, Union, Set
 from dataclasses import dataclass
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 import ray
+from ray.actor import ActorHandle
 from ray._raylet import GcsClient
+from ray.serve._private.constants import (
+    DEPLOYMENT_SCHEDULER_NODE_CACHE_TTL_S,
+    RAY_SERVE_SCHEDULER_DEBUG,
+    SERVE_LOGGER_NAME,
+)
 from ray.serve._private.utils import get_all_node_ids
 from ray.util.scheduling_strategies import NodeAffinitySchedulingStrategy
 
+logger = logging.getLogger(SERVE_LOGGER_NAME)
+
+# Sentinel for dict lookups where None is a valid value (e.g. unknown node id).
+_NOT_FOUND = object()
+
 
 class SpreadDeploymentSchedulingPolicy:
     """A scheduling policy that spreads replicas with best effort."""
@@ -28,6 +45,17 @@ class ReplicaSchedulingRequest:
     based on the deployment scheduling policy.
     """
 
+    # Declared explicitly since dataclass(slots=True) requires Python 3.10.
+    __slots__ = (
+        "deployment_name",
+        "replica_name",
+        "actor_def",
+        "actor_resources",
+        "actor_options",
+        "actor_init_args",
+        "on_scheduled",
+    )
+
     deployment_name: str
     replica_name: str
     actor_def: ray.actor.ActorClass
@@ -45,6 +73,8 @@ class DeploymentDownscaleRequest:
     choosing the replicas to stop.
     """
 
+    __slots__ = ("deployment_name", "num_to_stop")
+
     deployment_name: str
     num_to_stop: int
 
@@ -57,24 +87,66 @@ class DeploymentScheduler:
 
     def __init__(self):
         # {deployment_name: scheduling_policy}
-        self._deployments = {}
+        self._deployments: Dict[
+            str,
+            Union[SpreadDeploymentSchedulingPolicy, DriverDeploymentSchedulingPolicy],
+        ] = {}
+        # The scheduling function matching each deployment's scheduling policy.
+        # {deployment_name: schedule_fn}
+        self._deployment_schedule_fns: Dict[
+            str,
+            Callable[[str, List[Tuple[ReplicaSchedulingRequest, ActorHandle]]], None],
+        ] = {}
+        # Deployments with DriverDeploymentSchedulingPolicy.
+        self._driver_deployments: Set[str] = set()
         # Replicas that are waiting to be scheduled.
         # {deployment_name: {replica_name: deployment_upscale_request}}
-        self._pending_replicas = defaultdict(dict)
+        self._pending_replicas: Dict[
+            str, Dict[str, ReplicaSchedulingRequest]
+        ] = defaultdict(dict)
+        # Deployments that have at least one pending replica.
+        self._deployments_with_pending: Set[str] = set()
         # Replicas that are being scheduled.
         # The underlying actors have been submitted.
         # {deployment_name: {replica_name: target_node_id}}
-        self._launching_replicas = defaultdict(dict)
+        self._launching_replicas: Dict[str, Dict[str, Optional[str]]] = defaultdict(
+            dict
+        )
         # Replicas that are recovering.
         # We don't know where those replicas are running.
         # {deployment_name: {replica_name}}
-        self._recovering_replicas = defaultdict(set)
+        self._recovering_replicas: Dict[str, Set[str]] = defaultdict(set)
         # Replicas that are running.
         # We know where those replicas are running.
         # {deployment_name: {replica_name: running_node_id}}
-        self._running_replicas = defaultdict(dict)
+        self._running_replicas: Dict[str, Dict[str, Optional[str]]] = defaultdict(dict)
+        # Inverse view of running replicas, kept in sync with _running_replicas.
+        # {deployment_name: {running_node_id: {replica_name}}}
+        self._deployment_node_to_replicas: Dict[
+            str, Dict[Optional[str], Set[str]]
+        ] = defaultdict(lambda: defaultdict(set))
+        # Nodes that have launching or running replicas with a known node id.
+        # {deployment_name: {node_id: num_replicas}}
+        self._deployment_scheduled_nodes: Dict[str, Dict[str, int]] = defaultdict(
+            Counter
+        )
 
         self._gcs_client = GcsClient(address=ray.get_runtime_context().gcs_address)
+        # Sorted ids of alive nodes in the cluster,
+        # cached to avoid a GCS RPC per update cycle.
+        self._cached_all_nodes: List[str] = []
+        # Hard node affinity strategies for the cached nodes, reused across replicas.
+        # {node_id: NodeAffinitySchedulingStrategy}
+        self._node_affinity_strategies: Dict[str, NodeAffinitySchedulingStrategy] = {}
+        self._cached_nodes_dirty: bool = True
+        self._cached_nodes_refresh_time_s: float = 0.0
+        # In-flight background fetch of the alive nodes, see _prefetch_nodes().
+        self._node_ids_future: Optional[Future] = None
+        self._node_ids_future_submit_time_s: float = 0.0
+        self._node_ids_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="serve-deployment-scheduler"
+        )
+        self._is_shutdown: bool = False
 
     def on_deployment_created(
         self,
@@ -84,55 +156,149 @@ class DeploymentScheduler:
         ],
     ) -> None:
         """Called whenever a new deployment is created."""
-        assert deployment_name not in self._pending_replicas
-        assert deployment_name not in self._launching_replicas
-        assert deployment_name not in self._recovering_replicas
-        assert deployment_name not in self._running_replicas
+        if RAY_SERVE_SCHEDULER_DEBUG:
+            assert deployment_name not in self._pending_replicas
+            assert deployment_name not in self._launching_replicas
+            assert deployment_name not in self._recovering_replicas
+            assert deployment_name not in self._running_replicas
         self._deployments[deployment_name] = scheduling_policy
+        if isinstance(scheduling_policy, SpreadDeploymentSchedulingPolicy):
+            self._deployment_schedule_fns[
+                deployment_name
+            ] = self._schedule_spread_deployment
+        else:
+            assert isinstance(scheduling_policy, DriverDeploymentSchedulingPolicy)
+            self._deployment_schedule_fns[
+                deployment_name
+            ] = self._schedule_driver_deployment
+            self._driver_deployments.add(deployment_name)
 
     def on_deployment_deleted(self, deployment_name: str) -> None:
         """Called whenever a deployment is deleted."""
-        assert not self._pending_replicas[deployment_name]
+        assert not self._pending_replicas.get(deployment_name)
         self._pending_replicas.pop(deployment_name, None)
+        self._deployments_with_pending.discard(deployment_name)
 
-        assert not self._launching_replicas[deployment_name]
+        assert not self._launching_replicas.get(deployment_name)
         self._launching_replicas.pop(deployment_name, None)
 
-        assert not self._recovering_replicas[deployment_name]
+        assert not self._recovering_replicas.get(deployment_name)
         self._recovering_replicas.pop(deployment_name, None)
 
-        assert not self._running_replicas[deployment_name]
+        assert not self._running_replicas.get(deployment_name)
         self._running_replicas.pop(deployment_name, None)
+        self._deployment_node_to_replicas.pop(deployment_name, None)
+        self._deployment_scheduled_nodes.pop(deployment_name, None)
 
         del self._deployments[deployment_name]
+        del self._deployment_schedule_fns[deployment_name]
+        self._driver_deployments.discard(deployment_name)
 
     def on_replica_stopping(self, deployment_name: str, replica_name: str) -> None:
         """Called whenever a deployment replica is being stopped."""
-        self._pending_replicas[deployment_name].pop(replica_name, None)
-        self._launching_replicas[deployment_name].pop(replica_name, None)
-        self._recovering_replicas[deployment_name].discard(replica_name)
-        self._running_replicas[deployment_name].pop(replica_name, None)
+        # A replica is tracked by exactly one of the stores below,
+        # so we only need to update the first one that has it.
+        # Use get() to avoid creating empty entries in the defaultdicts.
+        running_replicas = self._running_replicas.get(deployment_name)
+        if running_replicas:
+            node_id = running_replicas.pop(replica_name, _NOT_FOUND)
+            if node_id is not _NOT_FOUND:
+                self._remove_from_node_index(deployment_name, replica_name, node_id)
+                self._remove_scheduled_node(deployment_name, node_id)
+                return
+
+        launching_replicas = self._launching_replicas.get(deployment_name)
+        if launching_replicas:
+            node_id = launching_replicas.pop(replica_name, _NOT_FOUND)
+            if node_id is not _NOT_FOUND:
+                self._remove_scheduled_node(deployment_name, node_id)
+                return
+
+        recovering_replicas = self._recovering_replicas.get(deployment_name)
+        if recovering_replicas and replica_name in recovering_replicas:
+            recovering_replicas.remove(replica_name)
+            return
+
+        pending_replicas = self._pending_replicas.get(deployment_name)
+        if pending_replicas:
+            pending_replicas.pop(replica_name, None)
+            if not pending_replicas:
+                self._deployments_with_pending.discard(deployment_name)
 
     def on_replica_running(
-        self, deployment_name: str, replica_name: str, node_id: str
+        self, deployment_name: str, replica_name: str, node_id: Optional[str]
     ) -> None:
         """Called whenever a deployment replica is running with a known node id."""
-        assert replica_name not in self._pending_replicas[deployment_name]
+        if RAY_SERVE_SCHEDULER_DEBUG:
+            assert replica_name not in self._pending_replicas[deployment_name]
 
-        self._launching_replicas[deployment_name].pop(replica_name, None)
-        self._recovering_replicas[deployment_name].discard(replica_name)
+        running_replicas = self._running_replicas[deployment_name]
+        old_node_id = running_replicas.get(replica_name, _NOT_FOUND)
+        if old_node_id == node_id:
+            # Already known to be running on this node.
+            return
 
-        self._running_replicas[deployment_name][replica_name] = node_id
+        if old_node_id is not _NOT_FOUND:
+            self._remove_from_node_index(deployment_name, replica_name, old_node_id)
+            self._remove_scheduled_node(deployment_name, old_node_id)
+        else:
+            launching_node_id = self._launching_replicas[deployment_name].pop(
+                replica_name, _NOT_FOUND
+            )
+            if launching_node_id is not _NOT_FOUND:
+                self._remove_scheduled_node(deployment_name, launching_node_id)
+            else:
+                self._recovering_replicas[deployment_name].discard(replica_name)
+        if node_id is not None:
+            node_id = sys.intern(node_id)
+            self._deployment_scheduled_nodes[deployment_name][node_id] += 1
+        running_replicas[replica_name] = node_id
+        self._deployment_node_to_replicas[deployment_name][node_id].add(replica_name)
+
+    def _remove_from_node_index(
+        self, deployment_name: str, replica_name: str, node_id: Optional[str]
+    ) -> None:
+        node_to_replicas = self._deployment_node_to_replicas[deployment_name]
+        node_to_replicas[node_id].discard(replica_name)
+        if not node_to_replicas[node_id]:
+            del node_to_replicas[node_id]
+
+    def _remove_scheduled_node(
+        self, deployment_name: str, node_id: Optional[str]
+    ) -> None:
+        if node_id is None:
+            return
+        scheduled_nodes = self._deployment_scheduled_nodes[deployment_name]
+        scheduled_nodes[node_id] -= 1
+        if scheduled_nodes[node_id] <= 0:
+            del scheduled_nodes[node_id]
 
     def on_replica_recovering(self, deployment_name: str, replica_name: str) -> None:
         """Called whenever a deployment replica is recovering."""
-        assert replica_name not in self._pending_replicas[deployment_name]
-        assert replica_name not in self._launching_replicas[deployment_name]
-        assert replica_name not in self._running_replicas[deployment_name]
-        assert replica_name not in self._recovering_replicas[deployment_name]
+        if RAY_SERVE_SCHEDULER_DEBUG:
+            assert replica_name not in self._pending_replicas[deployment_name]
+            assert replica_name not in self._launching_replicas[deployment_name]
+            assert replica_name not in self._running_replicas[deployment_name]
+            assert replica_name not in self._recovering_replicas[deployment_name]
 
         self._recovering_replicas[deployment_name].add(replica_name)
 
+    def on_nodes_changed(self) -> None:
+        """Called whenever nodes are added to or removed from the cluster."""
+        self._cached_nodes_dirty = True
+        # An in-flight fetch might not reflect the change.
+        self._discard_node_ids_future()
+
+    def shutdown(self) -> None:
+        """Stop the background node fetches.
+
+        Nodes are fetched synchronously afterwards, so the scheduler can
+        still stop the remaining replicas.
+        """
+        self._is_shutdown = True
+        self._discard_node_ids_future()
+        self._node_ids_executor.shutdown(wait=False)
+
     def schedule(
         self,
         upscales: Dict[str, List[ReplicaSchedulingRequest]],
@@ -147,26 +313,39 @@ class DeploymentScheduler:
         Returns:
             The name of replicas to stop for each deployment.
         """
+        if not upscales and not downscales and not self._deployments_with_pending:
+            return {}
+
         for upscale in upscales.values():
             for replica_scheduling_request in upscale:
-                self._pending_replicas[replica_scheduling_request.deployment_name][
-                    replica_scheduling_request.replica_name
+                # Names are interned since they key several dicts per replica.
+                deployment_name = sys.intern(replica_scheduling_request.deployment_name)
+                self._pending_replicas[deployment_name][
+                    sys.intern(replica_scheduling_request.replica_name)
                 ] = replica_scheduling_request
-
-        for deployment_name, pending_replicas in self._pending_replicas.items():
-            if not pending_replicas:
-                continue
-
-            deployment_scheduling_policy = self._deployments[deployment_name]
-            if isinstance(
-                deployment_scheduling_policy, SpreadDeploymentSchedulingPolicy
+                self._deployments_with_pending.add(deployment_name)
+
+        # Submit the actors of all deployments first and run the callbacks
+        # afterwards so that actor creations are sent back to back.
+        scheduled_replicas = []
+        if not self._deployments_with_pending.isdisjoint(self._driver_deployments):
+            self._prefetch_nodes()
+        # Driver deployments go last so that the node fetch overlaps with
+        # scheduling the spread deployments.
+        # This also copies the set, which the scheduling functions update.
+        try:
+            for deployment_name in sorted(
+                self._deployments_with_pending,
+                key=self._driver_deployments.__contains__,
             ):
-                self._schedule_spread_deployment(deployment_name)
-            else:
-                assert isinstance(
-                    deployment_scheduling_policy, DriverDeploymentSchedulingPolicy
+                self._deployment_schedule_fns[deployment_name](
+                    deployment_name, scheduled_replicas
                 )
-                self._schedule_driver_deployment(deployment_name)
+        finally:
+            # Replicas submitted before a later deployment failed are already
+            # launching and must still get their actor handles.
+            for replica_scheduling_request, actor_handle in scheduled_replicas:
+                replica_scheduling_request.on_scheduled(actor_handle)
 
         deployment_to_replicas_to_stop = {}
         for downscale in downscales.values():
@@ -178,60 +357,143 @@ class DeploymentScheduler:
 
         return deployment_to_replicas_to_stop
 
-    def _schedule_spread_deployment(self, deployment_name: str) -> None:
-        for pending_replica_name in list(
-            self._pending_replicas[deployment_name].keys()
-        ):
-            replica_scheduling_request = self._pending_replicas[deployment_name][
-                pending_replica_name
-            ]
-
-            actor_handle = replica_scheduling_request.actor_def.options(
-                scheduling_strategy="SPREAD",
-                **replica_scheduling_request.actor_options,
-            ).remote(*replica_scheduling_request.actor_init_args)
-            del self._pending_replicas[deployment_name][pending_replica_name]
-            self._launching_replicas[deployment_name][pending_replica_name] = None
-            replica_scheduling_request.on_scheduled(actor_handle)
-
-    def _schedule_driver_deployment(self, deployment_name: str) -> None:
+    def _schedule_spread_deployment(
+        self,
+        deployment_name: str,
+        scheduled_replicas: List[Tuple[ReplicaSchedulingRequest, ActorHandle]],
+    ) -> None:
+        pending_replicas = self._pending_replicas[deployment_name]
+        launching_replicas = self._launching_replicas[deployment_name]
+        while pending_replicas:
+            (
+                pending_replica_name,
+                replica_scheduling_request,
+            ) = pending_replicas.popitem()
+
+            try:
+                actor_handle = replica_scheduling_request.actor_def.options(
+                    scheduling_strategy="SPREAD",
+                    **replica_scheduling_request.actor_options,
+                ).remote(*replica_scheduling_request.actor_init_args)
+            except Exception:
+                # Keep the replica pending so it is retried in the next cycle.
+                pending_replicas[pending_replica_name] = replica_scheduling_request
+                raise
+            launching_replicas[pending_replica_name] = None
+            scheduled_replicas.append((replica_scheduling_request, actor_handle))
+
+        self._deployments_with_pending.discard(deployment_name)
+
+    def _schedule_driver_deployment(
+        self,
+        deployment_name: str,
+        scheduled_replicas: List[Tuple[ReplicaSchedulingRequest, ActorHandle]],
+    ) -> None:
         if self._recovering_replicas[deployment_name]:
             # Wait until recovering is done before scheduling new replicas
             # so that we can make sure we don't schedule two replicas on the same node.
             return
 
-        all_nodes = {node_id for node_id, _ in get_all_node_ids(self._gcs_client)}
-        scheduled_nodes = set()
-        for node_id in self._launching_replicas[deployment_name].values():
-            assert node_id is not None
-            scheduled_nodes.add(node_id)
-        for node_id in self._running_replicas[deployment_name].values():
-            assert node_id is not None
-            scheduled_nodes.add(node_id)
-        unscheduled_nodes = all_nodes - scheduled_nodes
-
-        for pending_replica_name in list(
-            self._pending_replicas[deployment_name].keys()
-        ):
-            if not unscheduled_nodes:
-                return
+        pending_replicas = self._pending_replicas[deployment_name]
+        launching_replicas = self._launching_replicas[deployment_name]
+        scheduled_nodes = self._deployment_scheduled_nodes[deployment_name]
+        all_nodes = self._get_all_nodes_cached()
+        if len(all_nodes) - len(scheduled_nodes) < len(pending_replicas):
+            # Nodes might have been added since the cache was refreshed.
+            self.on_nodes_changed()
+            all_nodes = self._get_all_nodes_cached()
+        # Nodes are picked in sorted order so that the choice is stable
+        # across update cycles.
+        unscheduled_nodes = [
+            node_id for node_id in all_nodes if node_id not in scheduled_nodes
+        ]
+        next_node_idx = 0
+
+        while pending_replicas and next_node_idx < len(unscheduled_nodes):
+            (
+                pending_replica_name,
+                replica_scheduling_request,
+            ) = pending_replicas.popitem()
+
+            target_node_id = unscheduled_nodes[next_node_idx]
+            next_node_idx += 1
+            try:
+                actor_handle = replica_scheduling_request.actor_def.options(
+                    scheduling_strategy=self._node_affinity_strategies[target_node_id],
+                    **replica_scheduling_request.actor_options,
+                ).remote(*replica_scheduling_request.actor_init_args)
+            except Exception:
+                # Keep the replica pending so it is retried in the next cycle.
+                pending_replicas[pending_replica_name] = replica_scheduling_request
+                raise
+            launching_replicas[pending_replica_name] = target_node_id
+            scheduled_nodes[target_node_id] += 1
+            scheduled_replicas.append((replica_scheduling_request, actor_handle))
+
+        if not pending_replicas:
+            self._deployments_with_pending.discard(deployment_name)
+
+    def _is_node_cache_stale(self, now: float) -> bool:
+        return (
+            self._cached_nodes_dirty
+            or now - self._cached_nodes_refresh_time_s
+            > DEPLOYMENT_SCHEDULER_NODE_CACHE_TTL_S
+        )
 
-            replica_scheduling_request = self._pending_replicas[deployment_name][
-                pending_replica_name
-            ]
-
-            target_node_id = unscheduled_nodes.pop()
-            actor_handle = replica_scheduling_request.actor_def.options(
-                scheduling_strategy=NodeAffinitySchedulingStrategy(
-                    target_node_id, soft=False
-                ),
-                **replica_scheduling_request.actor_options,
-            ).remote(*replica_scheduling_request.actor_init_args)
-            del self._pending_replicas[deployment_name][pending_replica_name]
-            self._launching_replicas[deployment_name][
-                pending_replica_name
-            ] = target_node_id
-            replica_scheduling_request.on_scheduled(actor_handle)
+    def _prefetch_nodes(self) -> None:
+        """Start fetching the alive nodes in the background if the cache is stale."""
+        if self._is_shutdown:
+            return
+        now = time.monotonic()
+        if self._node_ids_future is None and self._is_node_cache_stale(now):
+            self._node_ids_future = self._node_ids_executor.submit(
+                get_all_node_ids, self._gcs_client
+            )
+            self._node_ids_future_submit_time_s = now
+
+    def _discard_node_ids_future(self) -> None:
+        """Drop the in-flight background fetch so its result is never used."""
+        if self._node_ids_future is not None:
+            self._node_ids_future.cancel()
+            self._node_ids_future = None
+
+    def _get_all_nodes_cached(self) -> List[str]:
+        """Get the sorted ids of all alive nodes, refreshing the cache if stale."""
+        now = time.monotonic()
+        if self._is_node_cache_stale(now):
+            node_ids = None
+            future, self._node_ids_future = self._node_ids_future, None
+            # The nodes are only as fresh as the time the fetch was started.
+            # A prefetch older than the TTL might miss a replaced node, which
+            # doesn't change the node count and so doesn't mark the cache dirty.
+            refresh_time_s = self._node_ids_future_submit_time_s
+            if (
+                future is not None
+                and now - refresh_time_s <= DEPLOYMENT_SCHEDULER_NODE_CACHE_TTL_S
+            ):
+                try:
+                    node_ids = future.result()
+                except Exception:
+                    logger.warning(
+                        "Failed to prefetch the alive nodes, fetching them again.",
+                        exc_info=True,
+                    )
+            elif future is not None:
+                # Don't leave an outdated fetch running next to the new one.
+                if not future.cancel():
+                    wait([future])
+            if node_ids is None:
+                node_ids = get_all_node_ids(self._gcs_client)
+                refresh_time_s = now
+            self._cached_all_nodes = sorted(node_id for node_id, _ in node_ids)
+            self._node_affinity_strategies = {
+                node_id: self._node_affinity_strategies.get(node_id)
+                or NodeAffinitySchedulingStrategy(node_id, soft=False)
+                for node_id in self._cached_all_nodes
+            }
+            self._cached_nodes_dirty = False
+            self._cached_nodes_refresh_time_s = refresh_time_s
+        return self._cached_all_nodes
 
     def _get_replicas_to_stop(
         self, deployment_name: str, max_num_to_stop: int
@@ -247,24 +509,24 @@ class DeploymentScheduler:
 
         # Replicas not in running state don't have node id.
         # We will prioritize those first.
-        pending_launching_recovering_replicas = set().union(
-            self._pending_replicas[deployment_name].keys(),
-            self._launching_replicas[deployment_name].keys(),
+        # A replica is in at most one of these, so no deduplication is needed.
+        for pending_launching_recovering_replica in chain(
+            self._pending_replicas[deployment_name],
+            self._launching_replicas[deployment_name],
             self._recovering_replicas[deployment_name],
-        )
-        for (
-            pending_launching_recovering_replica
-        ) in pending_launching_recovering_replicas:
+        ):
             if len(replicas_to_stop) == max_num_to_stop:
                 return replicas_to_stop
             else:
                 replicas_to_stop.add(pending_launching_recovering_replica)
 
-        node_to_running_replicas = defaultdict(set)
-        for running_replica, node_id in self._running_replicas[deployment_name].items():
-            node_to_running_replicas[node_id].add(running_replica)
-        for running_replicas in sorted(
-            node_to_running_replicas.values(), key=lambda lst: len(lst)
+        # Every node has at least one running replica, so the nodes with
+        # the fewest replicas among the first `num_remaining` are enough.
+        num_remaining = max_num_to_stop - len(replicas_to_stop)
+        for running_replicas in heapq.nsmallest(
+            num_remaining,
+            self._deployment_node_to_replicas[deployment_name].values(),
+            key=len,
         ):
             for running_replica in running_replicas:
                 if len(replicas_to_stop) == max_num_to_stop:
@@ -2090,6 +2090,7 @@ class DriverDeploymentState(DeploymentState):
                 # For driver deployment, when there are new node,
                 # it is supposed to update the target state.
                 if self._target_state.num_replicas != num_nodes:
+                    self._deployment_scheduler.on_nodes_changed()
                     self._target_state.num_replicas = num_nodes
                     curr_info = self._target_state.info
                     new_config = copy(curr_info)
@@ -2275,6 +2276,7 @@ class DeploymentStateManager:
 
         for deployment_state in self._deployment_states.values():
             deployment_state.delete()
+        self._deployment_scheduler.shutdown()
 
         # TODO(jiaodong): This might not be 100% safe since we deleted
         # everything without ensuring all shutdown goals are completed
@@ -5,7 +5,9 @@ import os
 import logging
 import pickle
 import socket
+import sys
 import time
+from functools import lru_cache
 from typing import Callable, Dict, List, Optional, Set, Tuple
 
 import uvicorn
@@ -88,20 +90,82 @@ if os.environ.get("SERVE_REQUEST_PROCESSING_TIMEOUT_S") is not None:
     )
 
 
+# Number of recent request paths whose route match LongestPrefixRouter caches.
+ROUTE_MATCH_CACHE_SIZE = 4096
+
+# (route, handle, app_name, is_cross_language) returned by match_route.
+_RouteMatch = Tuple[str, RayServeHandle, str, bool]
+
+
+class _RouteTrieNode:
+    """Node in LongestPrefixRouter's radix tree of '/'-separated segments."""
+
+    __slots__ = ("segments", "children", "match", "slash_match")
+
+    def __init__(self, segments: List[str]):
+        # Segments on the edge from the parent to this node. Chains of nodes
+        # without routes are merged, so there can be more than one.
+        self.segments = segments
+        # Children keyed by the first segment on their edge.
+        self.children: Dict[str, "_RouteTrieNode"] = dict()
+        # While building the tree, the route stored on this node and the route
+        # with a trailing '/' stored on it. Once built, the longest match for a
+        # target that ends at this node and for one that continues past it.
+        self.match: Optional[_RouteMatch] = None
+        self.slash_match: Optional[_RouteMatch] = None
+
+
 class LongestPrefixRouter:
     """Router that performs longest prefix matches on incoming routes."""
 
     def __init__(self, get_handle: Callable):
         # Function to get a handle given a name. Used to mock for testing.
         self._get_handle = get_handle
-        # Routes sorted in order of decreasing length.
-        self.sorted_routes: List[str] = list()
+        # Trie of the routes split on '/'.
+        self._route_trie = _RouteTrieNode([])
+        # Longest matching route for targets that are a route, or a route
+        # without a trailing '/' plus a '/'.
+        self._exact_matches: Dict[str, _RouteMatch] = dict()
         # Endpoints associated with the routes.
         self.route_info: Dict[str, Tuple[EndpointTag, ApplicationName]] = dict()
         # Contains a ServeHandle for each endpoint.
         self.handles: Dict[str, RayServeHandle] = dict()
         # Map of application name to is_cross_language.
         self.app_to_is_cross_language: Dict[ApplicationName, bool] = dict()
+        self._reset_match_route_cache(self._match_route_uncached)
+
+    def _reset_match_route_cache(
+        self, match_route_uncached: Callable[[str], Optional[_RouteMatch]]
+    ):
+        # Replace the cache rather than clearing it, so no result computed
+        # for the old routes survives update_routes.
+        self._cached_match_route = lru_cache(maxsize=ROUTE_MATCH_CACHE_SIZE)(
+            match_route_uncached
+        )
+
+    @staticmethod
+    def _make_single_route_matcher(
+        route: str, match: _RouteMatch
+    ) -> Callable[[str], Optional[_RouteMatch]]:
+        """Return a matcher for a router with only one route.
+
+        Matches the same targets as the tree would, with a string comparison
+        instead of a dict lookup and a walk.
+        """
+        if route.endswith("/"):
+
+            def match_single_route(target_route: str) -> Optional[_RouteMatch]:
+                return match if target_route.startswith(route) else None
+
+        else:
+            route_with_slash = route + "/"
+
+            def match_single_route(target_route: str) -> Optional[_RouteMatch]:
+                if target_route == route or target_route.startswith(route_with_slash):
+                    return match
+                return None
+
+        return match_single_route
 
     def endpoint_exists(self, endpoint: EndpointTag) -> bool:
         return endpoint in self.handles
@@ -112,11 +176,9 @@ class LongestPrefixRouter:
         )
 
         existing_handles = set(self.handles.keys())
-        routes = []
         route_info = {}
         app_to_is_cross_language = {}
         for endpoint, info in endpoints.items():
-            routes.append(info.route)
             route_info[info.route] = (endpoint, info.app_name)
             app_to_is_cross_language[info.app_name] = info.app_is_cross_language
             if endpoint in self.handles:
@@ -140,50 +202,134 @@ class LongestPrefixRouter:
         for endpoint in existing_handles:
             del self.handles[endpoint]
 
-        # Routes are sorted in order of decreasing length to enable longest
-        # prefix matching.
-        self.sorted_routes = sorted(routes, key=lambda x: len(x), reverse=True)
+        # The match for each route is built once here and returned as is. Keys
+        # of the lookup dicts are interned, which keeps one copy of each string
+        # and lets equal keys compare by identity.
+        matches = {}
+        for route, (endpoint, app_name) in route_info.items():
+            route = sys.intern(route)
+            matches[route] = (
+                route,
+                self.handles[endpoint],
+                app_name,
+                app_to_is_cross_language[app_name],
+            )
+
+        # A route without a trailing '/' matches targets that have all of its
+        # segments, e.g. '/a/b' matches '/a/b' and '/a/b/c' but not '/a/bc'. A
+        # route with a trailing '/' is stored on the node of the segments before
+        # the '/' and matches only targets that have more segments after them.
+        route_trie = _RouteTrieNode([])
+        for route, match in matches.items():
+            segments = [sys.intern(segment) for segment in route.split("/")]
+            has_trailing_slash = route.endswith("/")
+            if has_trailing_slash:
+                segments.pop()
+
+            node = route_trie
+            for segment in segments:
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = _RouteTrieNode([segment])
+                node = child
+
+            if has_trailing_slash:
+                node.slash_match = match
+            else:
+                node.match = match
+
+        # Merge nodes that have no route and a single child into that child,
+        # and push each node's matches down to its descendants. A target that
+        # ends at or falls off a node then matches what is stored there, and
+        # the walk needs no bookkeeping of earlier matches.
+        nodes_to_compress = [route_trie]
+        while nodes_to_compress:
+            node = nodes_to_compress.pop()
+            for segment, child in node.children.items():
+                while (
+                    child.match is None
+                    and child.slash_match is None
+                    and len(child.children) == 1
+                ):
+                    (grandchild,) = child.children.values()
+                    grandchild.segments = child.segments + grandchild.segments
+                    child = grandchild
+                node.children[segment] = child
+
+                # A target continuing past the child is matched by the child's
+                # route with a '/', then its route, then whatever matched a
+                # target continuing past the parent.
+                if child.slash_match is None:
+                    if child.match is not None:
+                        child.slash_match = child.match
+                    else:
+                        child.slash_match = node.slash_match
+                if child.match is None:
+                    child.match = node.slash_match
+                nodes_to_compress.append(child)
+
+        # '/a/' is matched by '/a' unless '/a/' is a route itself.
+        exact_matches = {
+            sys.intern(route + "/"): match
+            for route, match in matches.items()
+            if not route.endswith("/")
+        }
+        exact_matches.update(matches)
+
+        self._route_trie = route_trie
+        self._exact_matches = exact_matches
         self.route_info = route_info
         self.app_to_is_cross_language = app_to_is_cross_language
 
-    def match_route(
-        self, target_route: str
-    ) -> Optional[Tuple[str, RayServeHandle, str, bool]]:
+        # Many applications have a single route, which needs no lookup tables.
+        if len(matches) == 1:
+            ((route, match),) = matches.items()
+            self._reset_match_route_cache(self._make_single_route_matcher(route, match))
+        else:
+            self._reset_match_route_cache(self._match_route_uncached)
+
+    def _match_route_in_tree(self, target_route: str) -> Optional[_RouteMatch]:
+        """Return the match for the longest route that prefixes target_route."""
+        # Walk down the tree as far as the target's segments follow its edges.
+        node = self._route_trie
+        segments = target_route.split("/")
+        num_segments = len(segments)
+        i = 0
+        while i < num_segments:
+            child = node.children.get(segments[i])
+            if child is None:
+                return node.slash_match
+            num_edge_segments = len(child.segments)
+            if (
+                num_edge_segments > 1
+                and segments[i : i + num_edge_segments] != child.segments
+            ):
+                # The target leaves the edge, or ends partway along it.
+                return node.slash_match
+            i += num_edge_segments
+            node = child
+
+        return node.match
+
+    def _match_route_uncached(self, target_route: str) -> Optional[_RouteMatch]:
+        # Most requests are for a route itself, which needs no tree walk.
+        matched = self._exact_matches.get(target_route)
+        if matched is None:
+            matched = self._match_route_in_tree(target_route)
+        return matched
+
+    def match_route(self, target_route: str) -> Optional[_RouteMatch]:
         """Return the longest prefix match among existing routes for the route.
 
+        Results are cached until the next call to update_routes.
+
         Args:
             target_route: route to match against.
 
         Returns:
             (route, handle, app_name, is_cross_language) if found, else None.
         """
-
-        for route in self.sorted_routes:
-            if target_route.startswith(route):
-                matched = False
-                # If the route we matched on ends in a '/', then so does the
-                # target route and this must be a match.
-                if route.endswith("/"):
-                    matched = True
-                # If the route we matched on doesn't end in a '/', we need to
-                # do another check to ensure that either this is an exact match
-                # or the next character in the target route is a '/'. This is
-                # to guard against the scenario where we have '/route' as a
-                # prefix and there's a request to '/routesuffix'. In this case,
-                # it should *not* be a match.
-                elif len(target_route) == len(route) or target_route[len(route)] == "/":
-                    matched = True
-
-                if matched:
-                    endpoint, app_name = self.route_info[route]
-                    return (
-                        route,
-                        self.handles[endpoint],
-                        app_name,
-                        self.app_to_is_cross_language[app_name],
-                    )
-
-        return None
+        return self._cached_match_route(target_route)
 
 
 class HTTPProxy:
@@ -1,6 +1,10 @@
+import copy
+import itertools
 import pytest
 import sys
-from typing import Dict, List, Tuple
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Set, Tuple
 from unittest.mock import Mock, patch, PropertyMock
 
 from ray.exceptions import RayTaskError
@@ -17,7 +21,6 @@ from ray.serve._private.common import (
     ReplicaConfig,
     DeploymentInfo,
 )
-from ray.serve._private.utils import get_random_letters
 from ray.serve.exceptions import RayServeException
 from ray.serve.tests.test_deployment_state import MockKVStore
 
@@ -34,12 +37,28 @@ class MockEndpointState:
             del self.endpoints[endpoint]
 
 
+# Returned by MockDeploymentStateManager.get_deployment for any known deployment.
+_DUMMY_DEPLOYMENT_INFO = DeploymentInfo(
+    deployment_config=DeploymentConfig(num_replicas=1, user_config={}),
+    replica_config=ReplicaConfig.create(lambda x: x),
+    start_time_ms=0,
+    deployer_job_id="",
+)
+
+
 class MockDeploymentStateManager:
     def __init__(self, kv_store):
         self.kv_store = kv_store
         self.deployment_infos: Dict[str, DeploymentInfo] = dict()
         self.deployment_statuses: Dict[str, DeploymentStatusInfo] = dict()
         self.deleting: Dict[str, bool] = dict()
+        # {name: (deployment_info, deleting)}, kept in sync with the dicts above.
+        self._checkpoint: Dict[str, Tuple[DeploymentInfo, bool]] = dict()
+        # While > 0, checkpoint writes are deferred until the outermost batch exits.
+        self._batch_depth = 0
+        self._checkpoint_dirty = False
+        # {app_name: {deployment names}}, kept in sync with deployment_infos.
+        self._by_app: Dict[str, Set[str]] = defaultdict(set)
 
         # Recover
         recovered_deployments = self.kv_store.get("fake_deployment_state_checkpoint")
@@ -48,13 +67,25 @@ class MockDeploymentStateManager:
                 (info, deleting) = checkpointed_data
 
                 self.deployment_infos[name] = info
+                self._by_app[info.app_name].add(name)
                 self.deployment_statuses[name] = DeploymentStatus.UPDATING
                 self.deleting[name] = deleting
+                self._checkpoint[name] = (info, deleting)
 
     def deploy(self, deployment_name: str, deployment_info: DeploymentInfo):
         existing_info = self.deployment_infos.get(deployment_name)
+        if (
+            existing_info is deployment_info
+            and not self.deleting.get(deployment_name, False)
+            and not self._checkpoint_dirty
+        ):
+            # Re-deploying the same info changes nothing, skip the checkpoint.
+            return
+
+        self._index_deployment(deployment_name, deployment_info)
         self.deleting[deployment_name] = False
         self.deployment_infos[deployment_name] = deployment_info
+        self._checkpoint[deployment_name] = (deployment_info, False)
         if not existing_info or existing_info.version != deployment_info.version:
             self.deployment_statuses[deployment_name] = DeploymentStatusInfo(
                 name=deployment_name,
@@ -62,15 +93,31 @@ class MockDeploymentStateManager:
                 message="",
             )
 
-        self.kv_store.put(
-            "fake_deployment_state_checkpoint",
-            dict(
-                zip(
-                    self.deployment_infos.keys(),
-                    zip(self.deployment_infos.values(), self.deleting.values()),
-                )
-            ),
-        )
+        self._checkpoint_dirty = True
+        if self._batch_depth == 0:
+            self._save_checkpoint()
+
+    def _index_deployment(self, name: str, info: DeploymentInfo):
+        existing_info = self.deployment_infos.get(name)
+        if existing_info is not None and existing_info.app_name != info.app_name:
+            self._by_app[existing_info.app_name].discard(name)
+        self._by_app[info.app_name].add(name)
+
+    @contextmanager
+    def batch(self):
+        """Write a single checkpoint for all deploys made inside the block."""
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._checkpoint_dirty:
+                self._save_checkpoint()
+
+    def _save_checkpoint(self):
+        # Store a snapshot so later updates don't leak into the checkpoint.
+        self.kv_store.put("fake_deployment_state_checkpoint", dict(self._checkpoint))
+        self._checkpoint_dirty = False
 
     @property
     def deployments(self) -> List[str]:
@@ -81,20 +128,10 @@ class MockDeploymentStateManager:
 
     def get_deployment(self, deployment_name: str) -> DeploymentInfo:
         if deployment_name in self.deployment_statuses:
-            # Return dummy deployment info object
-            return DeploymentInfo(
-                deployment_config=DeploymentConfig(num_replicas=1, user_config={}),
-                replica_config=ReplicaConfig.create(lambda x: x),
-                start_time_ms=0,
-                deployer_job_id="",
-            )
+            return _DUMMY_DEPLOYMENT_INFO
 
     def get_deployments_in_application(self, app_name: str):
-        return [
-            name
-            for name, info in self.deployment_infos.items()
-            if info.app_name == app_name
-        ]
+        return list(self._by_app.get(app_name, ()))
 
     def set_deployment_unhealthy(self, name: str):
         self.deployment_statuses[name].status = DeploymentStatus.UNHEALTHY
@@ -116,9 +153,11 @@ class MockDeploymentStateManager:
                 f"hasn't been called for {name} yet"
             )
 
-        del self.deployment_infos[name]
+        self._by_app[self.deployment_infos.pop(name).app_name].discard(name)
         del self.deployment_statuses[name]
         del self.deleting[name]
+        del self._checkpoint[name]
+        self._checkpoint_dirty = True
 
     def set_deployment(
         self,
@@ -126,40 +165,74 @@ class MockDeploymentStateManager:
         deployment_info: DeploymentInfo,
         status: DeploymentStatus,
     ):
+        self._index_deployment(deployment_name, deployment_info)
         self.deleting[deployment_name] = False
         self.deployment_infos[deployment_name] = deployment_info
+        self._checkpoint[deployment_name] = (deployment_info, False)
         self.deployment_statuses[deployment_name] = DeploymentStatusInfo(
             name=deployment_name,
             status=status,
             message="",
         )
+        self._checkpoint_dirty = True
 
     def delete_deployment(self, deployment_name: str):
         self.deleting[deployment_name] = True
+        if deployment_name in self.deployment_infos:
+            self._checkpoint[deployment_name] = (
+                self.deployment_infos[deployment_name],
+                True,
+            )
+            self._checkpoint_dirty = True
+
+
+@pytest.fixture(scope="session")
+def _shared_endpoint_state() -> MockEndpointState:
+    return MockEndpointState()
 
 
 @pytest.fixture
-def mocked_application_state_manager() -> Tuple[
-    ApplicationStateManager, MockDeploymentStateManager
+def endpoint_state(_shared_endpoint_state) -> MockEndpointState:
+    """Shared across tests, emptied after each one."""
+    yield _shared_endpoint_state
+    _shared_endpoint_state.endpoints.clear()
+
+
+@pytest.fixture(scope="session")
+def _application_state_manager_template() -> Tuple[
+    ApplicationStateManager, MockDeploymentStateManager, MockKVStore
 ]:
+    """Built once, each test gets its own deep copy."""
     kv_store = MockKVStore()
 
     deployment_state_manager = MockDeploymentStateManager(kv_store)
     application_state_manager = ApplicationStateManager(
         deployment_state_manager, MockEndpointState(), kv_store
     )
-    yield application_state_manager, deployment_state_manager, kv_store
+    return application_state_manager, deployment_state_manager, kv_store
+
+
+@pytest.fixture
+def mocked_application_state_manager(
+    _application_state_manager_template,
+) -> Tuple[ApplicationStateManager, MockDeploymentStateManager, MockKVStore]:
+    # Copy the whole tuple at once so the copies keep referencing each other.
+    yield copy.deepcopy(_application_state_manager_template)
+
+
+# The replica config is the same for every deployment, so serialize it only once.
+_REPLICA_CONFIG_PROTO_BYTES = ReplicaConfig.create(lambda x: x).to_proto_bytes()
+# Every call to deployment_params gets a new, unique version.
+_version_counter = itertools.count()
 
 
 def deployment_params(name: str, route_prefix: str = None):
     return {
         "name": name,
         "deployment_config_proto_bytes": DeploymentConfig(
-            num_replicas=1, user_config={}, version=get_random_letters()
-        ).to_proto_bytes(),
-        "replica_config_proto_bytes": ReplicaConfig.create(
-            lambda x: x
+            num_replicas=1, user_config={}, version=f"v{next(_version_counter)}"
         ).to_proto_bytes(),
+        "replica_config_proto_bytes": _REPLICA_CONFIG_PROTO_BYTES,
         "deployer_job_id": "random",
         "route_prefix": route_prefix,
         "docs_path": None,
@@ -167,8 +240,11 @@ def deployment_params(name: str, route_prefix: str = None):
     }
 
 
-@pytest.fixture
-def mocked_application_state() -> Tuple[ApplicationState, MockDeploymentStateManager]:
+@pytest.fixture(scope="session")
+def _application_state_template() -> Tuple[
+    ApplicationState, MockDeploymentStateManager
+]:
+    """Built once, each test gets its own deep copy."""
     kv_store = MockKVStore()
 
     deployment_state_manager = MockDeploymentStateManager(kv_store)
@@ -178,68 +254,93 @@ def mocked_application_state() -> Tuple[ApplicationState, MockDeploymentStateMan
         MockEndpointState(),
         lambda *args, **kwargs: None,
     )
-    yield application_state, deployment_state_manager
-
-
-@patch.object(
-    ApplicationState, "target_deployments", PropertyMock(return_value=["a", "b", "c"])
-)
-class TestDetermineAppStatus:
-    @patch.object(ApplicationState, "get_deployments_statuses")
-    def test_running(self, get_deployments_statuses, mocked_application_state):
-        app_state, _ = mocked_application_state
-        get_deployments_statuses.return_value = [
-            DeploymentStatusInfo("a", DeploymentStatus.HEALTHY),
-            DeploymentStatusInfo("b", DeploymentStatus.HEALTHY),
-            DeploymentStatusInfo("c", DeploymentStatus.HEALTHY),
-        ]
-        assert app_state._determine_app_status() == (ApplicationStatus.RUNNING, "")
+    return application_state, deployment_state_manager
 
-    @patch.object(ApplicationState, "get_deployments_statuses")
-    def test_stay_running(self, get_deployments_statuses, mocked_application_state):
-        app_state, _ = mocked_application_state
-        app_state._status = ApplicationStatus.RUNNING
-        get_deployments_statuses.return_value = [
-            DeploymentStatusInfo("a", DeploymentStatus.HEALTHY),
-            DeploymentStatusInfo("b", DeploymentStatus.HEALTHY),
-            DeploymentStatusInfo("c", DeploymentStatus.HEALTHY),
-        ]
-        assert app_state._determine_app_status() == (ApplicationStatus.RUNNING, "")
 
-    @patch.object(ApplicationState, "get_deployments_statuses")
-    def test_deploying(self, get_deployments_statuses, mocked_application_state):
-        app_state, _ = mocked_application_state
-        get_deployments_statuses.return_value = [
-            DeploymentStatusInfo("a", DeploymentStatus.UPDATING),
-            DeploymentStatusInfo("b", DeploymentStatus.HEALTHY),
-            DeploymentStatusInfo("c", DeploymentStatus.HEALTHY),
-        ]
-        assert app_state._determine_app_status() == (ApplicationStatus.DEPLOYING, "")
+@pytest.fixture
+def mocked_application_state(
+    _application_state_template,
+) -> Tuple[ApplicationState, MockDeploymentStateManager]:
+    yield copy.deepcopy(_application_state_template)
 
-    @patch.object(ApplicationState, "get_deployments_statuses")
-    def test_deploy_failed(self, get_deployments_statuses, mocked_application_state):
-        app_state, _ = mocked_application_state
-        get_deployments_statuses.return_value = [
-            DeploymentStatusInfo("a", DeploymentStatus.UPDATING),
-            DeploymentStatusInfo("b", DeploymentStatus.HEALTHY),
-            DeploymentStatusInfo("c", DeploymentStatus.UNHEALTHY),
-        ]
-        status, error_msg = app_state._determine_app_status()
-        assert status == ApplicationStatus.DEPLOY_FAILED
-        assert error_msg
 
-    @patch.object(ApplicationState, "get_deployments_statuses")
-    def test_unhealthy(self, get_deployments_statuses, mocked_application_state):
+class TestDetermineAppStatus:
+    @pytest.fixture(autouse=True, scope="class")
+    def _patch_application_state(self, request):
+        """Patch ApplicationState once for all tests in this class."""
+        with patch.object(
+            ApplicationState,
+            "target_deployments",
+            PropertyMock(return_value=["a", "b", "c"]),
+        ), patch.object(
+            ApplicationState, "get_deployments_statuses"
+        ) as get_deployments_statuses:
+            request.cls.get_deployments_statuses = get_deployments_statuses
+            yield
+
+    @pytest.mark.parametrize(
+        "pre_status,statuses,expected_status",
+        [
+            (
+                None,
+                [DeploymentStatus.HEALTHY] * 3,
+                ApplicationStatus.RUNNING,
+            ),
+            (
+                ApplicationStatus.RUNNING,
+                [DeploymentStatus.HEALTHY] * 3,
+                ApplicationStatus.RUNNING,
+            ),
+            (
+                None,
+                [
+                    DeploymentStatus.UPDATING,
+                    DeploymentStatus.HEALTHY,
+                    DeploymentStatus.HEALTHY,
+                ],
+                ApplicationStatus.DEPLOYING,
+            ),
+            (
+                None,
+                [
+                    DeploymentStatus.UPDATING,
+                    DeploymentStatus.HEALTHY,
+                    DeploymentStatus.UNHEALTHY,
+                ],
+                ApplicationStatus.DEPLOY_FAILED,
+            ),
+            (
+                ApplicationStatus.RUNNING,
+                [
+                    DeploymentStatus.HEALTHY,
+                    DeploymentStatus.HEALTHY,
+                    DeploymentStatus.UNHEALTHY,
+                ],
+                ApplicationStatus.UNHEALTHY,
+            ),
+        ],
+        ids=["running", "stay_running", "deploying", "deploy_failed", "unhealthy"],
+    )
+    def test_determine_app_status(
+        self, mocked_application_state, pre_status, statuses, expected_status
+    ):
         app_state, _ = mocked_application_state
-        app_state._status = ApplicationStatus.RUNNING
-        get_deployments_statuses.return_value = [
-            DeploymentStatusInfo("a", DeploymentStatus.HEALTHY),
-            DeploymentStatusInfo("b", DeploymentStatus.HEALTHY),
-            DeploymentStatusInfo("c", DeploymentStatus.UNHEALTHY),
+        if pre_status is not None:
+            app_state._status = pre_status
+        self.get_deployments_statuses.return_value = [
+            DeploymentStatusInfo(name, status)
+            for name, status in zip(["a", "b", "c"], statuses)
         ]
         status, error_msg = app_state._determine_app_status()
-        assert status == ApplicationStatus.UNHEALTHY
-        assert error_msg
+        assert status == expected_status
+        # Only the failure states come with an error message.
+        if expected_status in (
+            ApplicationStatus.DEPLOY_FAILED,
+            ApplicationStatus.UNHEALTHY,
+        ):
+            assert error_msg
+        else:
+            assert error_msg == ""
 
 
 def test_deploy_and_delete_app(mocked_application_state):
@@ -255,7 +356,8 @@ def test_deploy_and_delete_app(mocked_application_state):
     assert app_status.status == ApplicationStatus.DEPLOYING
     assert app_status.deployment_timestamp > 0
 
-    app_state.update()
+    with deployment_state_manager.batch():
+        app_state.update()
     # After one update, deployments {d1, d2} should be created
     assert deployment_state_manager.get_deployment("d1")
     assert deployment_state_manager.get_deployment("d2")
@@ -404,14 +506,14 @@ def test_app_unhealthy(mocked_application_state):
 
 @patch("ray.serve._private.application_state.check_obj_ref_ready_nowait")
 @patch("ray.get")
-def test_deploy_through_config_succeed(get, check_obj_ref_ready_nowait):
+def test_deploy_through_config_succeed(get, check_obj_ref_ready_nowait, endpoint_state):
     """Test deploying through config successfully.
     Deploy obj ref finishes successfully, so status should transition to running.
     """
     kv_store = MockKVStore()
     deployment_state_manager = MockDeploymentStateManager(kv_store)
     app_state_manager = ApplicationStateManager(
-        deployment_state_manager, MockEndpointState(), kv_store
+        deployment_state_manager, endpoint_state, kv_store
     )
     # Create application state
     app_state_manager.create_application_state(name="test_app", deploy_obj_ref=Mock())
@@ -438,14 +540,14 @@ def test_deploy_through_config_succeed(get, check_obj_ref_ready_nowait):
 
 @patch("ray.serve._private.application_state.check_obj_ref_ready_nowait")
 @patch("ray.get", side_effect=RayTaskError(None, "intentionally failed", None))
-def test_deploy_through_config_fail(get, check_obj_ref_ready_nowait):
+def test_deploy_through_config_fail(get, check_obj_ref_ready_nowait, endpoint_state):
     """Test fail to deploy through config.
     Deploy obj ref errors out, so status should transition to deploy failed.
     """
     kv_store = MockKVStore()
     deployment_state_manager = MockDeploymentStateManager(kv_store)
     app_state_manager = ApplicationStateManager(
-        deployment_state_manager, MockEndpointState(), kv_store
+        deployment_state_manager, endpoint_state, kv_store
     )
     # Create application state
     app_state_manager.create_application_state(name="test_app", deploy_obj_ref=Mock())
@@ -471,7 +573,8 @@ def test_redeploy_same_app(mocked_application_state):
     assert app_state.status == ApplicationStatus.DEPLOYING
 
     # Update
-    app_state.update()
+    with deployment_state_manager.batch():
+        app_state.update()
     assert app_state.status == ApplicationStatus.DEPLOYING
     assert set(app_state.target_deployments) == {"a", "b"}
 
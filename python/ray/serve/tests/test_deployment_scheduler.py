@@ -1,9 +1,15 @@
+import copy
+import pickle
 import sys
+import time
+from concurrent.futures import Future
+from unittest.mock import Mock, patch
 
 import pytest
 
 import ray
 from ray.tests.conftest import *  # noqa
+from ray.serve._private.utils import get_all_node_ids
 from ray.serve._private.deployment_scheduler import (
     DeploymentScheduler,
     SpreadDeploymentSchedulingPolicy,
@@ -13,12 +19,38 @@ from ray.serve._private.deployment_scheduler import (
 )
 
 
+@pytest.fixture(autouse=True)
+def _enable_scheduler_invariant_checks(monkeypatch):
+    """Run the scheduler's invariant asserts, which are off by default."""
+    monkeypatch.setattr(
+        "ray.serve._private.deployment_scheduler.RAY_SERVE_SCHEDULER_DEBUG", True
+    )
+
+
 @ray.remote(num_cpus=1)
 class Replica:
     def get_node_id(self):
         return ray.get_runtime_context().get_node_id()
 
 
+def test_scheduling_requests_copy_and_pickle():
+    """Test that the slotted request dataclasses can be copied and pickled."""
+    upscale = ReplicaSchedulingRequest(
+        deployment_name="deployment1",
+        replica_name="replica1",
+        actor_def=None,
+        actor_resources={"CPU": 1},
+        actor_options={"name": "replica1"},
+        actor_init_args=(1, 2),
+        on_scheduled=len,
+    )
+    downscale = DeploymentDownscaleRequest(deployment_name="deployment1", num_to_stop=1)
+    for request in [upscale, downscale]:
+        assert copy.copy(request) == request
+        assert copy.deepcopy(request) == request
+        assert pickle.loads(pickle.dumps(request)) == request
+
+
 def test_spread_deployment_scheduling_policy_upscale(ray_start_cluster):
     """Test to make sure replicas are spreaded."""
     cluster = ray_start_cluster
@@ -266,5 +298,169 @@ def test_driver_deployment_scheduling_policy_upscale(ray_start_cluster):
     scheduler.on_deployment_deleted("deployment1")
 
 
+def test_node_cache(ray_start_cluster):
+    """Test to make sure the node list is only fetched from GCS when stale."""
+    cluster = ray_start_cluster
+    cluster.add_node(num_cpus=3)
+    cluster.wait_for_nodes()
+    ray.init(address=cluster.address)
+
+    scheduler = DeploymentScheduler()
+    nodes = scheduler._get_all_nodes_cached()
+    assert len(nodes) == 1
+    assert scheduler._get_all_nodes_cached() is nodes
+
+    cluster.add_node(num_cpus=3)
+    cluster.wait_for_nodes()
+    scheduler.on_nodes_changed()
+    assert len(scheduler._get_all_nodes_cached()) == 2
+
+
+def test_node_cache_prefetch(ray_start_cluster):
+    """Test that failed or outdated node prefetches aren't used."""
+    cluster = ray_start_cluster
+    cluster.add_node(num_cpus=3)
+    cluster.wait_for_nodes()
+    ray.init(address=cluster.address)
+
+    scheduler = DeploymentScheduler()
+    node_ids = get_all_node_ids(scheduler._gcs_client)
+    get_all_node_ids_path = "ray.serve._private.deployment_scheduler.get_all_node_ids"
+
+    # A failed prefetch falls back to fetching the nodes synchronously.
+    with patch(
+        get_all_node_ids_path, side_effect=[RuntimeError("GCS timeout"), node_ids]
+    ):
+        scheduler._prefetch_nodes()
+        scheduler._node_ids_future.exception()
+        assert len(scheduler._get_all_nodes_cached()) == 1
+    assert scheduler._node_ids_future is None
+
+    # If that fails too, the error isn't kept: the next call fetches again.
+    scheduler.on_nodes_changed()
+    with patch(get_all_node_ids_path, side_effect=RuntimeError("GCS timeout")):
+        scheduler._prefetch_nodes()
+        scheduler._node_ids_future.exception()
+        with pytest.raises(RuntimeError, match="GCS timeout"):
+            scheduler._get_all_nodes_cached()
+    assert scheduler._node_ids_future is None
+    assert len(scheduler._get_all_nodes_cached()) == 1
+
+    # A prefetch started more than a TTL ago is discarded.
+    outdated_future = Future()
+    outdated_future.set_result([("old_node", "")])
+    scheduler.on_nodes_changed()
+    scheduler._node_ids_future = outdated_future
+    scheduler._node_ids_future_submit_time_s = time.monotonic() - 3600
+    assert "old_node" not in scheduler._get_all_nodes_cached()
+    assert scheduler._node_ids_future is None
+
+    # After shutdown, the nodes are still fetched, just not in the background.
+    scheduler.shutdown()
+    scheduler.on_nodes_changed()
+    scheduler._prefetch_nodes()
+    assert scheduler._node_ids_future is None
+    assert len(scheduler._get_all_nodes_cached()) == 1
+
+
+def test_failed_submission_is_retried(ray_start_cluster):
+    """Test that a replica whose actor submission fails stays pending."""
+    cluster = ray_start_cluster
+    cluster.add_node(num_cpus=3)
+    cluster.wait_for_nodes()
+    ray.init(address=cluster.address)
+
+    actor_def = Mock()
+    actor_def.options.return_value.remote.side_effect = [
+        RuntimeError("submission failed"),
+        "actor_handle",
+    ]
+    on_scheduled = Mock()
+    scheduler = DeploymentScheduler()
+    scheduler.on_deployment_created("deployment1", SpreadDeploymentSchedulingPolicy())
+    with pytest.raises(RuntimeError, match="submission failed"):
+        scheduler.schedule(
+            upscales={
+                "deployment1": [
+                    ReplicaSchedulingRequest(
+                        deployment_name="deployment1",
+                        replica_name="replica1",
+                        actor_def=actor_def,
+                        actor_resources={"CPU": 1},
+                        actor_options={},
+                        actor_init_args=(),
+                        on_scheduled=on_scheduled,
+                    )
+                ]
+            },
+            downscales={},
+        )
+    on_scheduled.assert_not_called()
+
+    # The next update cycle submits the replica again.
+    scheduler.schedule(upscales={}, downscales={})
+    on_scheduled.assert_called_once_with("actor_handle")
+    scheduler.on_replica_stopping("deployment1", "replica1")
+    scheduler.on_deployment_deleted("deployment1")
+
+
+def test_callbacks_run_when_later_deployment_fails(ray_start_cluster):
+    """Test that submitted replicas get their actor handles even if scheduling
+    a later deployment in the same cycle fails."""
+    cluster = ray_start_cluster
+    cluster.add_node(num_cpus=3)
+    cluster.wait_for_nodes()
+    ray.init(address=cluster.address)
+
+    actor_def = Mock()
+    actor_def.options.return_value.remote.return_value = "actor_handle"
+    spread_on_scheduled = Mock()
+    driver_on_scheduled = Mock()
+    scheduler = DeploymentScheduler()
+    scheduler.on_deployment_created("deployment1", SpreadDeploymentSchedulingPolicy())
+    scheduler.on_deployment_created("deployment2", DriverDeploymentSchedulingPolicy())
+    with patch(
+        "ray.serve._private.deployment_scheduler.get_all_node_ids",
+        side_effect=RuntimeError("GCS timeout"),
+    ), pytest.raises(RuntimeError, match="GCS timeout"):
+        scheduler.schedule(
+            upscales={
+                "deployment1": [
+                    ReplicaSchedulingRequest(
+                        deployment_name="deployment1",
+                        replica_name="replica1",
+                        actor_def=actor_def,
+                        actor_resources={"CPU": 1},
+                        actor_options={},
+                        actor_init_args=(),
+                        on_scheduled=spread_on_scheduled,
+                    )
+                ],
+                "deployment2": [
+                    ReplicaSchedulingRequest(
+                        deployment_name="deployment2",
+                        replica_name="replica2",
+                        actor_def=actor_def,
+                        actor_resources={"CPU": 1},
+                        actor_options={},
+                        actor_init_args=(),
+                        on_scheduled=driver_on_scheduled,
+                    )
+                ],
+            },
+            downscales={},
+        )
+    spread_on_scheduled.assert_called_once_with("actor_handle")
+    driver_on_scheduled.assert_not_called()
+
+    # Once GCS is reachable again the driver replica gets scheduled.
+    scheduler.schedule(upscales={}, downscales={})
+    driver_on_scheduled.assert_called_once_with("actor_handle")
+    scheduler.on_replica_stopping("deployment1", "replica1")
+    scheduler.on_replica_stopping("deployment2", "replica2")
+    scheduler.on_deployment_deleted("deployment1")
+    scheduler.on_deployment_deleted("deployment2")
+
+
 if __name__ == "__main__":
     sys.exit(pytest.main(["-v", "-s", __file__]))
@@ -269,6 +269,12 @@ class MockDeploymentScheduler:
         assert replica_name not in self.replicas[deployment_name]
         self.replicas[deployment_name].add(replica_name)
 
+    def on_nodes_changed(self):
+        pass
+
+    def shutdown(self):
+        pass
+
     def schedule(self, upscales, downscales):
         for upscale in upscales.values():
             for replica_scheduling_request in upscale:
@@ -4,85 +4,71 @@ from ray.serve._private.common import EndpointInfo
 from ray.serve._private.http_proxy import LongestPrefixRouter
 
 
-@pytest.fixture
-def mock_longest_prefix_router() -> LongestPrefixRouter:
+@pytest.fixture(scope="module")
+def _longest_prefix_router() -> LongestPrefixRouter:
     def mock_get_handle(name, *args, **kwargs):
         return name
 
-    yield LongestPrefixRouter(mock_get_handle)
-
-
-def test_no_match(mock_longest_prefix_router):
-    router = mock_longest_prefix_router
-    router.update_routes({"endpoint": EndpointInfo(route="/hello", app_name="")})
-    assert router.match_route("/nonexistent") is None
-
-
-def test_default_route(mock_longest_prefix_router):
-    router = mock_longest_prefix_router
-    router.update_routes({"endpoint": EndpointInfo(route="/endpoint", app_name="")})
-
-    assert router.match_route("/nonexistent") is None
-
-    route, handle, app_name, app_is_cross_language = router.match_route("/endpoint")
-    assert all(
-        [
-            route == "/endpoint",
-            handle == "endpoint",
-            app_name == "",
-            not app_is_cross_language,
-        ]
-    )
-
-
-def test_trailing_slash(mock_longest_prefix_router):
-    router = mock_longest_prefix_router
-    router.update_routes(
-        {
-            "endpoint": EndpointInfo(route="/test", app_name=""),
-        }
-    )
-
-    route, handle, _, _ = router.match_route("/test/")
-    assert route == "/test" and handle == "endpoint"
-
-    router.update_routes(
-        {
-            "endpoint": EndpointInfo(route="/test/", app_name=""),
-        }
-    )
-
-    assert router.match_route("/test") is None
+    return LongestPrefixRouter(mock_get_handle)
 
 
-def test_prefix_match(mock_longest_prefix_router):
+@pytest.fixture
+def mock_longest_prefix_router(_longest_prefix_router) -> LongestPrefixRouter:
+    """Shared across the module, with its routes cleared before each test."""
+    _longest_prefix_router.update_routes({})
+    yield _longest_prefix_router
+
+
+_PREFIX_MATCH_ROUTES = {
+    "endpoint1": "/test/test2",
+    "endpoint2": "/test",
+    "endpoint3": "/",
+}
+_SEGMENT_BOUNDARY_ROUTES = {"endpoint1": "/route", "endpoint2": "/route/"}
+
+
+@pytest.mark.parametrize(
+    "routes,target_route,expected",
+    [
+        # No match.
+        ({"endpoint": "/hello"}, "/nonexistent", None),
+        # Default route.
+        ({"endpoint": "/endpoint"}, "/nonexistent", None),
+        ({"endpoint": "/endpoint"}, "/endpoint", ("/endpoint", "endpoint")),
+        # Trailing slash.
+        ({"endpoint": "/test"}, "/test/", ("/test", "endpoint")),
+        ({"endpoint": "/test/"}, "/test", None),
+        # Longest prefix match.
+        (_PREFIX_MATCH_ROUTES, "/test/test2/subpath", ("/test/test2", "endpoint1")),
+        (_PREFIX_MATCH_ROUTES, "/test/test2/", ("/test/test2", "endpoint1")),
+        (_PREFIX_MATCH_ROUTES, "/test/test2", ("/test/test2", "endpoint1")),
+        (_PREFIX_MATCH_ROUTES, "/test/subpath", ("/test", "endpoint2")),
+        (_PREFIX_MATCH_ROUTES, "/test/", ("/test", "endpoint2")),
+        (_PREFIX_MATCH_ROUTES, "/test", ("/test", "endpoint2")),
+        (_PREFIX_MATCH_ROUTES, "/test2", ("/", "endpoint3")),
+        (_PREFIX_MATCH_ROUTES, "/", ("/", "endpoint3")),
+        # A prefix only matches on a '/' boundary.
+        (_SEGMENT_BOUNDARY_ROUTES, "/routesuffix", None),
+        (_SEGMENT_BOUNDARY_ROUTES, "/rout", None),
+        (_SEGMENT_BOUNDARY_ROUTES, "/route", ("/route", "endpoint1")),
+        (_SEGMENT_BOUNDARY_ROUTES, "/route/", ("/route/", "endpoint2")),
+        (_SEGMENT_BOUNDARY_ROUTES, "/route/subpath", ("/route/", "endpoint2")),
+    ],
+)
+def test_match_route(mock_longest_prefix_router, routes, target_route, expected):
     router = mock_longest_prefix_router
     router.update_routes(
         {
-            "endpoint1": EndpointInfo(route="/test/test2", app_name=""),
-            "endpoint2": EndpointInfo(route="/test", app_name=""),
-            "endpoint3": EndpointInfo(route="/", app_name=""),
+            endpoint: EndpointInfo(route=route, app_name="")
+            for endpoint, route in routes.items()
         }
     )
 
-    route, handle, _, _ = router.match_route("/test/test2/subpath")
-    assert route == "/test/test2" and handle == "endpoint1"
-    route, handle, _, _ = router.match_route("/test/test2/")
-    assert route == "/test/test2" and handle == "endpoint1"
-    route, handle, _, _ = router.match_route("/test/test2")
-    assert route == "/test/test2" and handle == "endpoint1"
-
-    route, handle, _, _ = router.match_route("/test/subpath")
-    assert route == "/test" and handle == "endpoint2"
-    route, handle, _, _ = router.match_route("/test/")
-    assert route == "/test" and handle == "endpoint2"
-    route, handle, _, _ = router.match_route("/test")
-    assert route == "/test" and handle == "endpoint2"
-
-    route, handle, _, _ = router.match_route("/test2")
-    assert route == "/" and handle == "endpoint3"
-    route, handle, _, _ = router.match_route("/")
-    assert route == "/" and handle == "endpoint3"
+    if expected is None:
+        assert router.match_route(target_route) is None
+    else:
+        route, handle = expected
+        assert router.match_route(target_route) == (route, handle, "", False)
 
 
 def test_update_routes(mock_longest_prefix_router):
@@ -90,13 +76,11 @@ def test_update_routes(mock_longest_prefix_router):
     router.update_routes({"endpoint": EndpointInfo(route="/endpoint", app_name="app1")})
 
     route, handle, app_name, app_is_cross_language = router.match_route("/endpoint")
-    assert all(
-        [
-            route == "/endpoint",
-            handle == "endpoint",
-            app_name == "app1",
-            not app_is_cross_language,
-        ]
+    assert (
+        route == "/endpoint"
+        and handle == "endpoint"
+        and app_name == "app1"
+        and not app_is_cross_language
     )
 
     router.update_routes(
@@ -113,14 +97,28 @@ def test_update_routes(mock_longest_prefix_router):
 
     route, handle, app_name, app_is_cross_language = router.match_route("/endpoint2")
     assert route == "/endpoint2" and handle == "endpoint2" and app_name == "app2"
-    assert all(
-        [
-            route == "/endpoint2",
-            handle == "endpoint2",
-            app_name == "app2",
-            app_is_cross_language,
-        ]
+    assert (
+        route == "/endpoint2"
+        and handle == "endpoint2"
+        and app_name == "app2"
+        and app_is_cross_language
+    )
+
+
+def test_update_routes_after_miss(mock_longest_prefix_router):
+    router = mock_longest_prefix_router
+    router.update_routes({"endpoint": EndpointInfo(route="/endpoint", app_name="")})
+
+    # A cached miss must not outlive the update that adds the route.
+    assert router.match_route("/endpoint2") is None
+    router.update_routes(
+        {
+            "endpoint": EndpointInfo(route="/endpoint", app_name=""),
+            "endpoint2": EndpointInfo(route="/endpoint2", app_name=""),
+        }
     )
+    route, handle, _, _ = router.match_route("/endpoint2")
+    assert route == "/endpoint2" and handle == "endpoint2"
 
 
 if __name__ == "__main__":